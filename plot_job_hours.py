@@ -1,12 +1,60 @@
+import hashlib
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import plotly.io as pio
 from google.cloud import bigquery
+# Optional; without it results are read page by page over the REST API
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
 import plotly.express as px
 import logging
 import os
 from datetime import datetime
 from plotly.subplots import make_subplots
 
+# Encode figure JSON with orjson, which serializes NumPy arrays natively
+pio.json.config.default_engine = 'orjson'
+
+# Column dtypes applied when decoding BigQuery results
+RESULT_DTYPES = {
+    'LaborHoursPerUnit': 'float32',
+    'ProdStandard': 'float32',
+    'StartDate': 'datetime64[ns]'
+}
+
+# Rows fetched per page when reading results without the Storage API
+RESULT_PAGE_SIZE = 10000
+
+# Local Parquet cache of query results, keyed on the query text
+CACHE_DIR = 'cache'
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Above this many jobs the bar chart is drawn as a WebGL trace instead of SVG
+DENSE_TRACE_THRESHOLD = 5000
+
+# Summary statistics for the dataset
+JobStatistics = namedtuple('JobStatistics', [
+    'total_jobs', 'average_hours', 'max_hours', 'min_hours',
+    'jobs_over_standard', 'percent_over_standard'
+])
+
+# CSV column, table label and table display format for each statistic
+STATISTICS_COLUMNS = [
+    ('total_jobs', 'Total Jobs', 'Total Jobs', '{}'),
+    ('average_hours', 'Average Labor Hours Per Unit', 'Average Labor Hours/Unit', '{:.2f}'),
+    ('max_hours', 'Max Labor Hours Per Unit', 'Max Labor Hours/Unit', '{:.2f}'),
+    ('min_hours', 'Min Labor Hours Per Unit', 'Min Labor Hours/Unit', '{:.2f}'),
+    ('jobs_over_standard', 'Jobs Over Standard', 'Jobs Over Standard', '{}'),
+    ('percent_over_standard', 'Percentage Over Standard', 'Percentage Over Standard', '{:.1f}%')
+]
+
 def read_query_file():
     """Read the query from query.txt file."""
     try:
@@ -16,6 +64,16 @@ def read_query_file():
         logging.error(f"Error reading query file: {str(e)}")
         raise
 
+def compose_query(query):
+    """Wrap the base query so filtering and sorting happen in BigQuery."""
+    # Strip the trailing semicolon so the query can be used as a subquery
+    base_query = query.strip().rstrip(';')
+    return (
+        f"SELECT * FROM (\n{base_query}\n) "
+        "WHERE LaborHoursPerUnit <= 50 "
+        "ORDER BY StartDate"
+    )
+
 def execute_bigquery_query(query):
     """Execute BigQuery query and return results as DataFrame."""
     try:
@@ -24,29 +82,101 @@ def execute_bigquery_query(query):
         
         # Execute query
         query_job = client.query(query)
-        results = query_job.result()
         
-        # Convert to list of dictionaries
-        data = [dict(row) for row in results]
-        logging.info(f"Retrieved {len(data)} records from BigQuery")
+        if bigquery_storage is None:
+            # Without the Storage API, build the DataFrame page by page
+            # against the known schema instead of letting pandas infer it
+            results = query_job.result(page_size=RESULT_PAGE_SIZE)
+            columns = [field.name for field in results.schema]
+            frames = [
+                pd.DataFrame.from_records(
+                    [row.values() for row in page], columns=columns, coerce_float=False
+                )
+                for page in results.pages
+            ]
+        else:
+            # Download results as Arrow record batches via the Storage API. The
+            # ORDER BY in compose_query makes the client read a single stream to
+            # preserve row order; max_stream_count only fans out to one stream
+            # per CPU for unordered queries
+            results = query_job.result()
+            bqstorage_client = bigquery_storage.BigQueryReadClient()
+            frames = list(results.to_dataframe_iterable(
+                bqstorage_client=bqstorage_client,
+                dtypes=RESULT_DTYPES,
+                max_stream_count=os.cpu_count()
+            ))
+        
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=[field.name for field in results.schema])
         
-        # Convert to pandas DataFrame
-        return pd.DataFrame(data)
+        # Apply the expected dtypes; a no-op for columns already decoded typed
+        df = df.astype(
+            {col: dtype for col, dtype in RESULT_DTYPES.items() if col in df.columns}
+        )
+        logging.info(f"Retrieved {len(df)} records from BigQuery")
+        
+        return df
         
     except Exception as e:
         logging.error(f"Error querying BigQuery: {str(e)}")
         raise
 
+def get_cache_path(query, cache_dir=CACHE_DIR):
+    """Return the Parquet cache path for a query, keyed on its SHA-1."""
+    key = hashlib.sha1(query.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{key}.parquet')
+
+def load_query_results(query, ttl=CACHE_TTL_SECONDS):
+    """Load query results from the local cache, querying BigQuery on a miss."""
+    cache_path = get_cache_path(query)
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl:
+        # An unreadable cache file is treated as a miss
+        try:
+            df = pd.read_parquet(cache_path, engine='pyarrow')
+            logging.info(f"Loaded {len(df)} records from cache {cache_path}")
+            return df
+        except Exception as e:
+            logging.warning(f"Error reading cached query results: {str(e)}")
+    
+    df = execute_bigquery_query(query)
+    tmp_path = None
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # Write to a temporary file and move it into place so an interrupted
+        # write never leaves a partial cache file behind
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.parquet.tmp')
+        os.close(fd)
+        df.to_parquet(tmp_path, compression='zstd', engine='pyarrow')
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        logging.info(f"Query results cached to {cache_path}")
+    except Exception as e:
+        logging.warning(f"Error caching query results: {str(e)}")
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
+
 def calculate_statistics(df):
-    """Calculate statistics for the dataset."""
-    stats = {
-        'Total Jobs': len(df),
-        'Average Labor Hours Per Unit': df['LaborHoursPerUnit'].mean(),
-        'Max Labor Hours Per Unit': df['LaborHoursPerUnit'].max(),
-        'Min Labor Hours Per Unit': df['LaborHoursPerUnit'].min(),
-        'Jobs Over Standard': len(df[df['LaborHoursPerUnit'] > df['ProdStandard']]),
-        'Percentage Over Standard': (len(df[df['LaborHoursPerUnit'] > df['ProdStandard']]) / len(df)) * 100
-    }
+    """Calculate statistics for a non-empty dataset."""
+    # Read each column once and reduce on the underlying arrays
+    lh = df['LaborHoursPerUnit'].to_numpy()
+    ps = df['ProdStandard'].to_numpy()
+    over = int((lh > ps).sum())
+    
+    stats = JobStatistics(
+        total_jobs=len(df),
+        average_hours=lh.mean(dtype=np.float64),
+        max_hours=lh.max(),
+        min_hours=lh.min(),
+        jobs_over_standard=over,
+        percent_over_standard=(over / len(df)) * 100
+    )
     return stats
 
 def save_raw_data(df, stats, output_dir='output'):
@@ -58,15 +188,21 @@ def save_raw_data(df, stats, output_dir='output'):
         # Generate timestamp for filename
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         
-        # Save raw data
         data_filename = os.path.join(output_dir, f'job_hours_data_{timestamp}.csv')
-        df.to_csv(data_filename, index=False)
-        logging.info(f"Raw data saved to {data_filename}")
-        
-        # Save statistics
         stats_filename = os.path.join(output_dir, f'job_hours_stats_{timestamp}.csv')
-        pd.DataFrame([stats]).to_csv(stats_filename, index=False)
-        logging.info(f"Statistics saved to {stats_filename}")
+        
+        stats_df = pd.DataFrame([
+            {column: getattr(stats, field) for field, column, _, _ in STATISTICS_COLUMNS}
+        ])
+        
+        # Save raw data and statistics concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            data_future = executor.submit(df.to_csv, data_filename, index=False)
+            stats_future = executor.submit(stats_df.to_csv, stats_filename, index=False)
+            data_future.result()
+            logging.info(f"Raw data saved to {data_filename}")
+            stats_future.result()
+            logging.info(f"Statistics saved to {stats_filename}")
         
     except Exception as e:
         logging.error(f"Error saving data: {str(e)}")
@@ -82,27 +218,52 @@ def create_visualization(df, stats):
         row_heights=[0.6, 0.4]  # Adjusted proportions for single chart
     )
     
-    # Split data by ProdStandard
-    df_75 = df[df['ProdStandard'] == 7.5]
+    # Split data by ProdStandard, copying only the columns the chart uses
+    df_75 = df.loc[df['ProdStandard'] == 7.5, ['JobNum', 'LaborHoursPerUnit', 'StartDate']]
     
-    # Add bars for 7.5 standard
-    fig.add_trace(
-        go.Bar(
-            x=df_75['JobNum'],
-            y=df_75['LaborHoursPerUnit'],
+    jobs = df_75['JobNum'].to_numpy()
+    hours = df_75['LaborHoursPerUnit'].to_numpy()
+    
+    # Add bars for 7.5 standard, drawn with WebGL when there are too many
+    # jobs for SVG bars to render responsively
+    dense = len(df_75) > DENSE_TRACE_THRESHOLD
+    if dense:
+        # Draw each bar as a vertical line from 0 to its value, with a NaN
+        # point after each one to break the line between jobs
+        bar_x = np.repeat(jobs, 3)
+        bar_y = np.full(len(hours) * 3, np.nan, dtype='float32')
+        bar_y[0::3] = 0
+        bar_y[1::3] = hours
+        
+        jobs_trace = go.Scattergl(
+            x=bar_x,
+            y=bar_y,
+            name='Labor Hours (7.5 Standard)',
+            mode='lines',
+            line=dict(color='blue', width=2),
+            connectgaps=False,
+            hoverinfo='skip',
+            showlegend=True
+        )
+    else:
+        # Format dates once with a vectorized cast instead of per-row strftime
+        date_text = df_75['StartDate'].to_numpy().astype('datetime64[D]').astype(str)
+        
+        jobs_trace = go.Bar(
+            x=jobs,
+            y=hours,
             name='Labor Hours (7.5 Standard)',
             marker_color='blue',
             width=0.4,
-            text=df_75['StartDate'].dt.strftime('%Y-%m-%d'),
+            text=date_text,
             textposition='outside',
             hovertemplate="<b>Job Number:</b> %{x}<br>" +
                          "<b>Date:</b> %{text}<br>" +
                          "<b>Value:</b> %{y:.2f}<br>" +
                          "<extra></extra>",
             showlegend=True
-        ),
-        row=1, col=1
-    )
+        )
+    fig.add_trace(jobs_trace, row=1, col=1)
     
     # Add horizontal line for 7.5 standard
     fig.add_hline(
@@ -115,7 +276,7 @@ def create_visualization(df, stats):
     )
     
     # Add horizontal line for average
-    fig.add_hline(y=stats['Average Labor Hours Per Unit'], 
+    fig.add_hline(y=float(stats.average_hours), 
                  line_dash="dash", 
                  line_color="green",
                  name="Average Hours/Unit",
@@ -132,14 +293,8 @@ def create_visualization(df, stats):
         ),
         cells=dict(
             values=[
-                ['Total Jobs', 'Average Labor Hours/Unit', 'Max Labor Hours/Unit', 
-                 'Min Labor Hours/Unit', 'Jobs Over Standard', 'Percentage Over Standard'],
-                [f"{stats['Total Jobs']}", 
-                 f"{stats['Average Labor Hours Per Unit']:.2f}",
-                 f"{stats['Max Labor Hours Per Unit']:.2f}",
-                 f"{stats['Min Labor Hours Per Unit']:.2f}",
-                 f"{stats['Jobs Over Standard']}",
-                 f"{stats['Percentage Over Standard']:.1f}%"]
+                [label for _, _, label, _ in STATISTICS_COLUMNS],
+                [fmt.format(getattr(stats, field)) for field, _, _, fmt in STATISTICS_COLUMNS]
             ],
             fill_color='lavender',
             align='left',
@@ -175,9 +330,15 @@ def create_visualization(df, stats):
             orientation="h",
             traceorder="normal",
             groupclick="toggleitem"
-        )
+        ),
+        hovermode='x',
+        uirevision='job-hours'
     )
     
+    # Per-point hover distance checks freeze the browser on dense traces
+    if dense:
+        fig.update_layout(spikedistance=0, hoverdistance=1)
+    
     # Update x-axes
     fig.update_xaxes(tickangle=45, row=1, col=1, tickfont=dict(size=12))
     
@@ -202,28 +363,28 @@ def main():
     
     try:
         # Read and execute query
-        query = read_query_file()
-        df = execute_bigquery_query(query)
+        query = compose_query(read_query_file())
+        df = load_query_results(query)
         logging.info(f"Initial data count: {len(df)} records")
         
+        # Nothing to summarize or plot without any rows
+        if df.empty:
+            logging.warning("Query returned no records; skipping statistics and visualization")
+            return
+        
         # Convert StartDate to datetime if it's not already
-        df['StartDate'] = pd.to_datetime(df['StartDate'])
+        if not pd.api.types.is_datetime64_any_dtype(df['StartDate']):
+            df['StartDate'] = pd.to_datetime(df['StartDate'], utc=False, cache=True)
         
-        # Filter out records with LaborHoursPerUnit > 50
-        original_count = len(df)
-        df = df[df['LaborHoursPerUnit'] <= 50]
-        filtered_count = original_count - len(df)
-        if filtered_count > 0:
-            logging.info(f"Filtered out {filtered_count} records with LaborHoursPerUnit > 50")
+        # Downcast numeric columns to halve memory traffic and plot payload
+        df['LaborHoursPerUnit'] = df['LaborHoursPerUnit'].astype('float32')
+        df['ProdStandard'] = df['ProdStandard'].astype('float32')
+        if pd.api.types.is_integer_dtype(df['JobNum']):
+            df['JobNum'] = pd.to_numeric(df['JobNum'], downcast='integer')
         
         # Log counts by ProdStandard
         prod_standard_counts = df['ProdStandard'].value_counts()
-        logging.info("Records by Production Standard:")
-        for standard, count in prod_standard_counts.items():
-            logging.info(f"  Standard {standard}: {count} records")
-        
-        # Sort by StartDate
-        df = df.sort_values('StartDate')
+        logging.info("Records by Production Standard:\n%s", prod_standard_counts.to_string())
         
         # Calculate statistics
         stats = calculate_statistics(df)
@@ -235,7 +396,14 @@ def main():
         fig = create_visualization(df, stats)
         
         # Save the plot as an HTML file
-        fig.write_html('job_hours_analysis.html')
+        # Load plotly.js from the CDN rather than inlining the ~3MB bundle
+        fig.write_html(
+            'job_hours_analysis.html',
+            include_plotlyjs='cdn',
+            full_html=True,
+            validate=False,
+            div_id='p'
+        )
         logging.info("Visualization has been saved as 'job_hours_analysis.html'")
         
     except Exception as e: